@@ -1,11 +1,15 @@
 """Kubernetes operator to manage IamIdentityMappings in the aws-config configmap."""
 
 import asyncio
+import dataclasses
+import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from os import environ
 from pathlib import Path
-from typing import Any, List
+from typing import Any, Dict, List, Optional
 
 import kopf
 import yaml
@@ -29,6 +33,7 @@ else:
 
 API = client.CoreV1Api()
 custom_objects_api = client.CustomObjectsApi()
+extensions_api = client.ApiextensionsV1Api()
 GROUP = "iamauthenticator.k8s.aws"
 VERSION = "v1alpha1"
 PLURAL = "iamidentitymappings"
@@ -40,6 +45,49 @@ IGNORED_CM_IDENTITIES = [
     "system:node:{{EC2PrivateDNSName}}",
 ]
 
+# Usernames written by the operator in the aws-auth ConfigMap of a KUBE_CONTEXTS cluster.
+# Only these can be pruned, the other mappings of the ConfigMap are never removed.
+MANAGED_IDENTITIES_ANNOTATION = f"{GROUP}/managed-identities"
+
+# Multi-cluster mode defaults, each one can be overridden by the environment variable of the same name.
+CLUSTER_SYNC_INTERVAL = 300
+CLUSTER_SYNC_TIMEOUT = 60
+CLUSTER_SYNC_MAX_PARALLELISM = 4
+
+
+@dataclasses.dataclass(frozen=True)
+class ClusterClients:
+    """Kubernetes API clients bound to a single cluster."""
+
+    name: str
+    core_api: client.CoreV1Api
+    custom_objects_api: client.CustomObjectsApi
+    extensions_api: client.ApiextensionsV1Api
+    request_timeout: Optional[float] = None
+
+    @property
+    def request_options(self) -> dict:
+        """Return the keyword arguments to pass to every API call made with these clients."""
+        return {"_request_timeout": self.request_timeout} if self.request_timeout else {}
+
+
+@dataclasses.dataclass
+class ClusterStats:
+    """Reconciliation metrics of a single cluster, exposed by the `clusters` probe."""
+
+    successes: int = 0
+    failures: int = 0
+    timeouts: int = 0
+    skipped: int = 0
+    # Number of times the configmap was found out of sync while it was last known in sync
+    drifts: int = 0
+    in_flight: bool = False
+    # Whether the last check found the configmap in sync, None when unknown
+    in_sync: Optional[bool] = None
+    last_duration: Optional[float] = None
+    last_success: Optional[float] = None
+    last_error: Optional[str] = None
+
 
 @kopf.on.update(GROUP, VERSION, PLURAL)
 @kopf.on.create(GROUP, VERSION, PLURAL)  # type: ignore
@@ -84,47 +132,290 @@ async def delete_mapping(spec: dict, **_: Any) -> None:
 
 
 @kopf.on.startup()
-def on_startup(logger, **_: Any) -> None:  # type: ignore
+def on_startup(memo: kopf.Memo, logger, **_: Any) -> None:  # type: ignore
     """Deploy the CRD and synchronize the existing mappings on startup."""
-    # Do a full synchronization at the start
-    logger.info("Deploy CRD definition")
-    deploy_crd_definition()
-    logger.info("Reconcile all existing resources")
-    full_synchronize()
+    stats = memo.setdefault("cluster_stats", {}).setdefault("local", ClusterStats())
+    start = time.monotonic()
+    try:
+        # Do a full synchronization at the start
+        logger.info("Deploy CRD definition")
+        deploy_crd_definition()
+        logger.info("Reconcile all existing resources")
+        full_synchronize()
+    except Exception as error:
+        stats.failures += 1
+        stats.last_error = format(error)
+        raise
+    else:
+        stats.successes += 1
+        stats.last_success = time.time()
+        stats.last_error = None
+    finally:
+        stats.last_duration = time.monotonic() - start
+
+
+@kopf.on.startup()
+async def start_multi_cluster(memo: kopf.Memo, logger, **_: Any) -> None:  # type: ignore
+    """Start reconciling the clusters listed in KUBE_CONTEXTS, if any, in the background."""
+    contexts = get_cluster_contexts()
+    if not contexts:
+        return
+
+    max_parallelism = int(environ.get("CLUSTER_SYNC_MAX_PARALLELISM", CLUSTER_SYNC_MAX_PARALLELISM))
+    if max_parallelism < 1:
+        raise kopf.PermanentError(f"CLUSTER_SYNC_MAX_PARALLELISM must be at least 1, got {max_parallelism}")
+
+    logger.info("Reconcile the clusters of kubeconfig contexts %s", contexts)
+    memo.setdefault("cluster_stats", {}).update({context: ClusterStats() for context in contexts})
+    memo.cluster_clients = {}
+    memo.multi_cluster_task = asyncio.create_task(
+        reconcile_clusters_forever(
+            contexts,
+            memo.cluster_clients,
+            memo.cluster_stats,
+            max_parallelism=max_parallelism,
+            interval=float(environ.get("CLUSTER_SYNC_INTERVAL", CLUSTER_SYNC_INTERVAL)),
+            timeout=float(environ.get("CLUSTER_SYNC_TIMEOUT", CLUSTER_SYNC_TIMEOUT)),
+        )
+    )
+
+
+@kopf.on.cleanup()
+async def stop_multi_cluster(memo: kopf.Memo, **_: Any) -> None:
+    """Stop the background reconciliation of the clusters listed in KUBE_CONTEXTS and release their connections."""
+    task = memo.get("multi_cluster_task")
+    if task is None:
+        return
+
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+    for clients in memo.get("cluster_clients", {}).values():
+        clients.core_api.api_client.close()
 
 
 @kopf.on.probe(id="sync")
-def get_monitoring_status(**_: Any) -> bool:
+def get_monitoring_status(memo: kopf.Memo, **_: Any) -> bool:
     """Check if the aws-auth configmap mappings are in sync with the IamIdentityMappings."""
-    return check_synchronization()
+    stats = memo.setdefault("cluster_stats", {}).setdefault("local", ClusterStats())
+    # The local cluster is not repaired between two checks, a drift lasts until a check finds it in sync again
+    last_known_in_sync = stats.in_sync is not False
+    try:
+        check_synchronization()
+    except RuntimeError:
+        _record_sync_status(stats, False, last_known_in_sync)
+        raise
+    except Exception as error:
+        stats.failures += 1
+        stats.last_error = format(error)
+        stats.in_sync = None
+        raise
+    _record_sync_status(stats, True, last_known_in_sync)
+    return True
+
+
+@kopf.on.probe(id="clusters")
+def get_cluster_metrics(memo: kopf.Memo, **_: Any) -> dict:
+    """Report the metrics of the local cluster and of each cluster listed in KUBE_CONTEXTS."""
+    return {name: dataclasses.asdict(stats) for name, stats in memo.get("cluster_stats", {}).items()}
+
+
+def get_cluster_contexts() -> List[str]:
+    """Return the kubeconfig contexts listed in the comma separated KUBE_CONTEXTS environment variable."""
+    return [context.strip() for context in environ.get("KUBE_CONTEXTS", "").split(",") if context.strip()]
+
+
+def get_local_clients() -> ClusterClients:
+    """Return the clients of the cluster the operator is logged in."""
+    return ClusterClients("local", API, custom_objects_api, extensions_api)
+
+
+def load_cluster_clients(context: str, request_timeout: Optional[float] = None) -> ClusterClients:
+    """Create the clients of a kubeconfig context.
+
+    All the clients of a cluster share the same ApiClient, and therefore the same connection pool.
+
+    :param context: The name of the kubeconfig context
+    :param request_timeout: The number of seconds after which each API call made for the cluster is aborted
+    :return clients: The clients bound to the cluster of the context
+    """
+    try:
+        api_client = config.new_client_from_config(context=context)
+    except Exception as error:
+        error_str = format(error)
+        raise RuntimeError(f"Could not load kubeconfig context {context} ({error_str})") from error
+
+    return ClusterClients(
+        context,
+        client.CoreV1Api(api_client),
+        client.CustomObjectsApi(api_client),
+        client.ApiextensionsV1Api(api_client),
+        request_timeout,
+    )
+
+
+async def reconcile_clusters_forever(
+    contexts: List[str],
+    clients_by_context: Dict[str, ClusterClients],
+    stats: Dict[str, ClusterStats],
+    max_parallelism: int,
+    interval: float,
+    timeout: float,
+) -> None:
+    """Reconcile every cluster periodically, each one on its own schedule.
+
+    :param contexts: The kubeconfig contexts of the clusters to reconcile
+    :param clients_by_context: The clients of each cluster, filled as they are loaded
+    :param stats: The metrics of each cluster, by context
+    :param max_parallelism: The maximum number of clusters reconciled at the same time
+    :param interval: The number of seconds to wait between two reconciliations of a cluster
+    :param timeout: The number of seconds after which a reconciliation is considered failed
+    """
+    semaphore = asyncio.Semaphore(max_parallelism)
+    # One worker per cluster: a cluster never has more than one reconciliation running,
+    # so a hung cluster cannot starve the others of threads.
+    executor = ThreadPoolExecutor(max_workers=len(contexts), thread_name_prefix="cluster")
+
+    async def reconcile_periodically(context: str) -> None:
+        while True:
+            await reconcile_cluster(context, clients_by_context, stats[context], executor, semaphore, timeout)
+            await asyncio.sleep(interval)
 
+    try:
+        await asyncio.gather(*(reconcile_periodically(context) for context in contexts))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def reconcile_cluster(
+    context: str,
+    clients_by_context: Dict[str, ClusterClients],
+    stats: ClusterStats,
+    executor: ThreadPoolExecutor,
+    semaphore: asyncio.Semaphore,
+    timeout: float,
+) -> None:
+    """Reconcile a single cluster and record the outcome in its metrics.
+
+    Errors are logged and recorded, never raised, so a failing cluster does not affect the others.
+    A reconciliation exceeding the timeout is recorded as failed and keeps running in the background
+    until its API calls reach the request timeout of the clients. The cluster is skipped and keeps
+    its slot of the semaphore until then.
+
+    :param context: The kubeconfig context of the cluster to reconcile
+    :param clients_by_context: The clients of each cluster, filled as they are loaded
+    :param stats: The metrics of the cluster
+    :param executor: The executor running the blocking Kubernetes calls
+    :param semaphore: The semaphore bounding the number of clusters reconciled at the same time
+    :param timeout: The number of seconds after which the reconciliation is considered failed
+    """
+    if stats.in_flight:
+        stats.skipped += 1
+        logger.warning("Previous reconciliation of cluster %s is still running, skipping", context)
+        return
 
-def check_synchronization() -> bool:
-    """Compare the aws-auth configmap to the IamIdentityMappings and return if they are in sync."""
+    # The semaphore is released by the done callback, once the worker thread actually returns
+    await semaphore.acquire()
+    stats.in_flight = True
+    start = time.monotonic()
+    try:
+        future = asyncio.get_running_loop().run_in_executor(
+            executor, synchronize_cluster, context, clients_by_context, timeout, stats.successes == 0
+        )
+    except BaseException:
+        stats.in_flight = False
+        semaphore.release()
+        raise
+    future.add_done_callback(lambda done: _on_cluster_synchronized(stats, semaphore, done))
+    try:
+        in_sync = await asyncio.wait_for(asyncio.shield(future), timeout)
+    except TimeoutError:
+        stats.timeouts += 1
+        stats.failures += 1
+        stats.in_sync = None
+        stats.last_error = f"Reconciliation timed out after {timeout}s"
+        logger.error("Reconciliation of cluster %s timed out after %ss", context, timeout)
+    except Exception as error:
+        stats.failures += 1
+        stats.in_sync = None
+        stats.last_error = format(error)
+        logger.error("Reconciliation of cluster %s failed: %s", context, error)
+    else:
+        stats.successes += 1
+        stats.last_success = time.time()
+        stats.last_error = None
+        # Every reconciliation repairs the configmap, so it was last known in sync
+        _record_sync_status(stats, in_sync, last_known_in_sync=True)
+    finally:
+        stats.last_duration = time.monotonic() - start
+
+
+def _record_sync_status(stats: ClusterStats, in_sync: bool, last_known_in_sync: bool) -> None:
+    """Record whether the configmap of a cluster was found in sync, counting each drift once."""
+    if not in_sync and last_known_in_sync:
+        stats.drifts += 1
+    stats.in_sync = in_sync
+
+
+def _on_cluster_synchronized(stats: ClusterStats, semaphore: asyncio.Semaphore, future: asyncio.Future) -> None:
+    """Mark the reconciliation of a cluster as done and free its slot, once its worker thread returns."""
+    stats.in_flight = False
+    semaphore.release()
+    # Retrieve the error of a reconciliation that timed out, so it is not reported as never retrieved
+    if not future.cancelled():
+        future.exception()
+
+
+def synchronize_cluster(
+    context: str, clients_by_context: Dict[str, ClusterClients], request_timeout: float, deploy_crd: bool
+) -> bool:
+    """Load the clients of a cluster if needed, deploy the CRD if requested and synchronize all its mappings.
+
+    :param context: The kubeconfig context of the cluster to synchronize
+    :param clients_by_context: The clients of each cluster, filled as they are loaded
+    :param request_timeout: The number of seconds after which each API call made for the cluster is aborted
+    :param deploy_crd: Whether to deploy the CRD definition before synchronizing
+    :return in_sync: Whether the aws-auth configmap was in sync before being synchronized
+    """
+    clients = clients_by_context.get(context)
+    if clients is None:
+        # Loading a context can run its exec plugin and fail transiently, it is retried at the next reconciliation
+        clients = clients_by_context[context] = load_cluster_clients(context, request_timeout)
+    if deploy_crd:
+        deploy_crd_definition(clients)
+    # Deletions are not watched in these clusters, prune the mappings of deleted IamIdentityMappings instead
+    return full_synchronize(clients, prune=True)
 
-    identity_mappings = custom_objects_api.list_cluster_custom_object(GROUP, VERSION, PLURAL)
+
+def check_synchronization(clients: Optional[ClusterClients] = None) -> bool:
+    """Compare the aws-auth configmap to the IamIdentityMappings and return if they are in sync.
+
+    :param clients: The clients of the cluster to check, defaults to the local cluster
+    """
+    clients = clients or get_local_clients()
+
+    identity_mappings = clients.custom_objects_api.list_cluster_custom_object(
+        GROUP, VERSION, PLURAL, **clients.request_options
+    )
     identities_in_crd = [im["spec"]["username"] for im in identity_mappings["items"]]
 
-    configmap = API.read_namespaced_config_map("aws-auth", "kube-system")
+    configmap = clients.core_api.read_namespaced_config_map("aws-auth", "kube-system", **clients.request_options)
     identities_in_cm = get_cm_identity_mappings(configmap)
     identities_in_cm = identities_in_cm if isinstance(identities_in_cm, list) else []
     identities_in_cm = [u["username"] for u in identities_in_cm]
 
-    # Allow some mappings in the aws-auth ConfigMap to exist without being defined
-    # in an IamIdentityMapping object.
-    identities_to_ignore: List[str] = deepcopy(IGNORED_CM_IDENTITIES)
-
-    if "IGNORED_CM_IDENTITIES" in environ:
-        identities_to_ignore = identities_to_ignore + environ.get("IGNORED_CM_IDENTITIES", "").split(",")
-
-    identities_in_cm_set = set(identities_in_cm) - set(identities_to_ignore)
+    identities_in_cm_set = set(identities_in_cm) - set(get_ignored_identities())
     identities_in_crd_set = set(identities_in_crd)
 
     if identities_in_cm_set != identities_in_crd_set:
         logger.error(
-            "The aws-auth configmap and the IamIdentityMappings are out of sync.\n"
+            "The aws-auth configmap and the IamIdentityMappings of cluster %s are out of sync.\n"
             "The following users are in the aws-auth configmap but not in the IamIdentityMappings: %s\n"
             "The following users are in the IamIdentityMappings but not in the aws-auth configmap: %s\n",
+            clients.name,
             list(identities_in_cm_set - identities_in_crd_set),
             list(identities_in_crd_set - identities_in_cm_set),
         )
@@ -135,44 +426,103 @@ def check_synchronization() -> bool:
     return True
 
 
-def deploy_crd_definition() -> None:
-    """Deploy the CRD (IamIdentityMapping) located in kubernetes/."""
+def get_ignored_identities() -> List[str]:
+    """Return the usernames allowed in the aws-auth configmap without being defined in an IamIdentityMapping."""
+    identities_to_ignore: List[str] = deepcopy(IGNORED_CM_IDENTITIES)
+
+    if "IGNORED_CM_IDENTITIES" in environ:
+        identities_to_ignore = identities_to_ignore + environ.get("IGNORED_CM_IDENTITIES", "").split(",")
+
+    return identities_to_ignore
+
+
+def deploy_crd_definition(clients: Optional[ClusterClients] = None) -> None:
+    """Deploy the CRD (IamIdentityMapping) located in kubernetes/.
+
+    :param clients: The clients of the cluster to deploy to, defaults to the local cluster
+    """
+    clients = clients or get_local_clients()
     crd_file_path = get_project_root() / "kubernetes" / "iamidentitymappings.yaml"
     with open(crd_file_path.resolve(), "r", encoding="UTF8") as stream:
         body = yaml.safe_load(stream)
-    extensions_api = client.ApiextensionsV1Api()
-    crds = extensions_api.list_custom_resource_definition()
+    crds = clients.extensions_api.list_custom_resource_definition(**clients.request_options)
     crds_name = {x["metadata"]["name"]: x["metadata"]["resource_version"] for x in crds.to_dict()["items"]}
     crd_name = body["metadata"]["name"]
     if crd_name not in crds_name.keys():
         try:
-            extensions_api.create_custom_resource_definition(body)
+            clients.extensions_api.create_custom_resource_definition(body, **clients.request_options)
         except ValueError as err:
             if err.args[0] != "Invalid value for `conditions`, must not be `None`":
                 raise err
     else:
         body["metadata"]["resourceVersion"] = crds_name[crd_name]
-        extensions_api.replace_custom_resource_definition(crd_name, body)
+        clients.extensions_api.replace_custom_resource_definition(crd_name, body, **clients.request_options)
 
 
-def full_synchronize() -> None:
+def full_synchronize(clients: Optional[ClusterClients] = None, prune: bool = False) -> bool:
     """Synchronize all aws-auth configmap mappings with existing IamIdentityMappings.
 
     Important note: This method will ignore any existing entries in mapUsers and mapRoles.
                     As long as they satisfy the CRD, they will be left unchanged in
-                    the aws-auth configmap.
+                    the aws-auth configmap. When pruning, only the entries previously written
+                    by the operator are removed once their IamIdentityMapping is gone.
+
+    :param clients: The clients of the cluster to synchronize, defaults to the local cluster
+    :param prune: Whether to remove the entries of deleted IamIdentityMappings, tracked in an annotation
+    :return in_sync: Whether the mappings of the aws-auth configmap were already in sync, with nothing to change
     """
+    clients = clients or get_local_clients()
     # Get Kubernetes" objects
-    configmap = API.read_namespaced_config_map("aws-auth", "kube-system")
-    identity_mappings = custom_objects_api.list_cluster_custom_object(GROUP, VERSION, PLURAL)
+    configmap = clients.core_api.read_namespaced_config_map("aws-auth", "kube-system", **clients.request_options)
+    identity_mappings = clients.custom_objects_api.list_cluster_custom_object(
+        GROUP, VERSION, PLURAL, **clients.request_options
+    )
 
     cm_identities = get_cm_identity_mappings(configmap)
     cm_identities = cm_identities if isinstance(cm_identities, list) else []
+    initial_cm_identities = deepcopy(cm_identities)
+
+    crd_identities = {im["spec"]["username"] for im in identity_mappings["items"]}
+    if prune and not crd_identities:
+        # An empty list is more likely a freshly deployed CRD than the removal of every mapping
+        logger.warning("No IamIdentityMapping in cluster %s, nothing is pruned", clients.name)
+    elif prune:
+        identities_to_prune = set(get_managed_identities(configmap)) - crd_identities - set(get_ignored_identities())
+        if identities_to_prune:
+            logger.info("Prune mappings of users %s, their IamIdentityMapping was deleted", sorted(identities_to_prune))
+        cm_identities = [i for i in cm_identities if i.get("username") not in identities_to_prune]
+        set_managed_identities(configmap, crd_identities)
 
     for identity_mapping in identity_mappings["items"]:
         cm_identities = ensure_identity(identity_mapping["spec"], cm_identities)
 
-    asyncio.run(apply_cm_identity_mappings(configmap, cm_identities))
+    in_sync = cm_identities == initial_cm_identities
+    if not in_sync:
+        logger.info("Update the aws-auth configmap mappings of cluster %s", clients.name)
+
+    asyncio.run(apply_cm_identity_mappings(configmap, cm_identities, clients))
+    return in_sync
+
+
+def get_managed_identities(configmap: V1ConfigMap) -> List[str]:
+    """Get the usernames the operator wrote in the aws-auth configmap, as recorded in its annotation.
+
+    :return identities: The managed usernames, empty if the annotation is missing
+    """
+    annotations = (configmap.metadata.annotations if configmap.metadata else None) or {}
+    return json.loads(annotations.get(MANAGED_IDENTITIES_ANNOTATION, "[]"))
+
+
+def set_managed_identities(configmap: V1ConfigMap, identities: set) -> None:
+    """Record the usernames the operator writes in the aws-auth configmap in its annotation.
+
+    :param configmap: The configmap to annotate
+    :param identities: The managed usernames
+    """
+    if configmap.metadata is None:
+        configmap.metadata = client.V1ObjectMeta()
+    annotations = configmap.metadata.annotations or {}
+    configmap.metadata.annotations = {**annotations, MANAGED_IDENTITIES_ANNOTATION: json.dumps(sorted(identities))}
 
 
 def get_cm_identity_mappings(configmap: V1ConfigMap) -> list:
@@ -193,12 +543,16 @@ def get_cm_identity_mappings(configmap: V1ConfigMap) -> list:
         raise yaml_error
 
 
-async def apply_cm_identity_mappings(existing_cm: V1ConfigMap, identity_mappings: list) -> None:
+async def apply_cm_identity_mappings(
+    existing_cm: V1ConfigMap, identity_mappings: list, clients: Optional[ClusterClients] = None
+) -> None:
     """Apply new identity mappings to override the existing aws-auth mapping.
 
     :param existing_cm: The current configmap
     :param identity_mappings: The new identity mappings
+    :param clients: The clients of the cluster to apply to, defaults to the local cluster
     """
+    clients = clients or get_local_clients()
     user_mappings = []
     role_mappings = []
     for identity_mapping in identity_mappings:
@@ -211,7 +565,7 @@ async def apply_cm_identity_mappings(existing_cm: V1ConfigMap, identity_mappings
 
     existing_cm.data["mapUsers"] = yaml.safe_dump(user_mappings)
     existing_cm.data["mapRoles"] = yaml.safe_dump(role_mappings)
-    API.patch_namespaced_config_map("aws-auth", "kube-system", existing_cm)
+    clients.core_api.patch_namespaced_config_map("aws-auth", "kube-system", existing_cm, **clients.request_options)
 
 
 def ensure_identity(identity: dict, identity_list: list) -> list:
@@ -224,7 +578,7 @@ def ensure_identity(identity: dict, identity_list: list) -> list:
 
     for i, existing_identity in enumerate(identity_list):
         # Handle existing identity
-        if existing_identity["username"] == identity["username"]:
+        if existing_identity.get("username") == identity["username"]:
             identity_list[i] = identity
             return identity_list
     # Handle new identity
@@ -241,7 +595,7 @@ def delete_identity(identity: dict, identity_list: list) -> list:
     """
 
     for i, existing_user in enumerate(identity_list):
-        if existing_user["username"] == identity["username"]:
+        if existing_user.get("username") == identity["username"]:
             del identity_list[i]
             return identity_list
 
@@ -1,5 +1,8 @@
 import asyncio
+import json
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from os import environ
 from unittest.mock import MagicMock, patch
 
@@ -256,7 +259,9 @@ def test_full_synchronize(mock_apply_identity_mappings, api_client, custom_objec
 
     iam_mapping.full_synchronize()
 
-    mock_apply_identity_mappings.assert_called_with(CONFIGMAP, [SPEC_USER_JOHNDOE, SPEC_CSEC_ADMIN])
+    mock_apply_identity_mappings.assert_called_with(
+        CONFIGMAP, [SPEC_USER_JOHNDOE, SPEC_CSEC_ADMIN], iam_mapping.get_local_clients()
+    )
     api_client.read_namespaced_config_map.assert_called_with("aws-auth", "kube-system")
     custom_objects_api.list_cluster_custom_object.assert_called_with(GROUP, VERSION, PLURAL)
 
@@ -358,3 +363,568 @@ def test_get_cm_identity_mappings_with_empty_configmap_returns_no_identity():
     ret = iam_mapping.get_cm_identity_mappings(CONFIGMAP_MISSING_DATA)
 
     assert len(ret) == 0
+
+
+def make_managed_configmap(identities, managed_identities=None):
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    metadata = None
+    if managed_identities is not None:
+        metadata = client.V1ObjectMeta(
+            annotations={iam_mapping.MANAGED_IDENTITIES_ANNOTATION: json.dumps(managed_identities)}
+        )
+    return client.V1ConfigMap(
+        api_version="v1",
+        kind="ConfigMap",
+        data={
+            "mapRoles": yaml.safe_dump([i for i in identities if "rolearn" in i]),
+            "mapUsers": yaml.safe_dump([i for i in identities if "userarn" in i]),
+        },
+        metadata=metadata,
+    )
+
+
+def make_cluster_clients(name, request_timeout=None):
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    core_api = MagicMock()
+    core_api.read_namespaced_config_map.return_value = make_managed_configmap([SPEC_CSEC_ADMIN, SPEC_USER_JOHNDOE])
+    objects_api = MagicMock()
+    objects_api.list_cluster_custom_object.return_value = IAM_IDENTITY_MAPPINGS
+    return iam_mapping.ClusterClients(name, core_api, objects_api, MagicMock(), request_timeout)
+
+
+def run_reconcile_cluster(clients, stats, timeout=5):
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    async def _reconcile():
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            await iam_mapping.reconcile_cluster(
+                clients.name, {clients.name: clients}, stats, executor, asyncio.Semaphore(1), timeout
+            )
+
+    run_sync(_reconcile())
+
+
+@patch.dict(environ, {"KUBE_CONTEXTS": "cluster-a, cluster-b,,"})
+def test_get_cluster_contexts():
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    assert iam_mapping.get_cluster_contexts() == ["cluster-a", "cluster-b"]
+
+
+@patch.dict(environ, {"KUBE_CONTEXTS": ""})
+def test_get_cluster_contexts_empty():
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    assert iam_mapping.get_cluster_contexts() == []
+
+
+def test_load_cluster_clients_shares_api_client():
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    with patch(f"{BASE_PATH}.config.new_client_from_config") as new_client_mock:
+        clients = iam_mapping.load_cluster_clients("cluster-a", request_timeout=10)
+
+    new_client_mock.assert_called_with(context="cluster-a")
+    assert clients.name == "cluster-a"
+    assert clients.request_timeout == 10
+    assert clients.core_api.api_client is new_client_mock.return_value
+    assert clients.custom_objects_api.api_client is new_client_mock.return_value
+    assert clients.extensions_api.api_client is new_client_mock.return_value
+
+
+def test_load_cluster_clients_unknown_context():
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    with patch(f"{BASE_PATH}.config.new_client_from_config", side_effect=Exception("no context")):
+        with raises(RuntimeError):
+            iam_mapping.load_cluster_clients("unknown")
+
+
+def test_full_synchronize_with_cluster_clients(api_client):
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    clients = make_cluster_clients("cluster-a")
+
+    iam_mapping.full_synchronize(clients)
+
+    clients.core_api.patch_namespaced_config_map.assert_called_once()
+    api_client.read_namespaced_config_map.assert_not_called()
+    api_client.patch_namespaced_config_map.assert_not_called()
+
+
+def test_full_synchronize_with_cluster_clients_request_timeout():
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    clients = make_cluster_clients("cluster-a", request_timeout=10)
+
+    iam_mapping.full_synchronize(clients)
+
+    clients.core_api.read_namespaced_config_map.assert_called_with("aws-auth", "kube-system", _request_timeout=10)
+    clients.custom_objects_api.list_cluster_custom_object.assert_called_with(
+        GROUP, VERSION, PLURAL, _request_timeout=10
+    )
+    assert clients.core_api.patch_namespaced_config_map.call_args.kwargs == {"_request_timeout": 10}
+
+
+def test_deploy_crd_definition_with_cluster_clients_request_timeout():
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    clients = make_cluster_clients("cluster-a", request_timeout=10)
+    clients.extensions_api.list_custom_resource_definition.return_value.to_dict.return_value = {"items": []}
+
+    iam_mapping.deploy_crd_definition(clients)
+
+    clients.extensions_api.list_custom_resource_definition.assert_called_with(_request_timeout=10)
+    assert clients.extensions_api.create_custom_resource_definition.call_args.kwargs == {"_request_timeout": 10}
+
+
+def test_reconcile_cluster_success():
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    clients = make_cluster_clients("cluster-a")
+    stats = iam_mapping.ClusterStats()
+
+    with patch(f"{BASE_PATH}.deploy_crd_definition") as deploy_crd_mock:
+        run_reconcile_cluster(clients, stats)
+        run_reconcile_cluster(clients, stats)
+
+    # The CRD is only deployed until the first successful reconciliation
+    deploy_crd_mock.assert_called_once_with(clients)
+    assert clients.core_api.patch_namespaced_config_map.call_count == 2
+    assert stats.successes == 2
+    assert stats.failures == 0
+    assert stats.last_success is not None
+    assert not stats.in_flight
+
+
+def test_reconcile_cluster_failure_is_recorded(caplog):
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    clients = make_cluster_clients("cluster-a")
+    clients.core_api.read_namespaced_config_map.side_effect = Exception("unreachable")
+    stats = iam_mapping.ClusterStats()
+
+    with patch(f"{BASE_PATH}.deploy_crd_definition"):
+        run_reconcile_cluster(clients, stats)
+
+    assert stats.successes == 0
+    assert stats.failures == 1
+    assert stats.last_error == "unreachable"
+    assert any("cluster-a" in message for message in caplog.messages)
+
+
+def test_reconcile_cluster_timeout_skips_until_done():
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    clients = make_cluster_clients("cluster-a")
+    configmap = clients.core_api.read_namespaced_config_map.return_value
+    release = threading.Event()
+    clients.core_api.read_namespaced_config_map.side_effect = lambda *_: release.wait(5) and configmap
+    stats = iam_mapping.ClusterStats()
+
+    async def _reconcile():
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            semaphore = asyncio.Semaphore(1)
+            clients_by_context = {clients.name: clients}
+            await iam_mapping.reconcile_cluster(clients.name, clients_by_context, stats, executor, semaphore, 0.01)
+            assert stats.in_flight
+            await iam_mapping.reconcile_cluster(clients.name, clients_by_context, stats, executor, semaphore, 0.01)
+            release.set()
+
+    with patch(f"{BASE_PATH}.deploy_crd_definition"):
+        run_sync(_reconcile())
+
+    assert stats.timeouts == 1
+    assert stats.failures == 1
+    assert stats.skipped == 1
+
+
+def test_reconcile_clusters_forever_isolates_failures():
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    failing = make_cluster_clients("failing")
+    failing.core_api.read_namespaced_config_map.side_effect = Exception("unreachable")
+    healthy = make_cluster_clients("healthy")
+    stats = {"failing": iam_mapping.ClusterStats(), "healthy": iam_mapping.ClusterStats()}
+
+    async def _reconcile():
+        task = asyncio.create_task(
+            iam_mapping.reconcile_clusters_forever(
+                ["failing", "healthy"],
+                {"failing": failing, "healthy": healthy},
+                stats,
+                max_parallelism=1,
+                interval=60,
+                timeout=5,
+            )
+        )
+        while stats["healthy"].successes + stats["failing"].failures < 2:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with raises(asyncio.CancelledError):
+            await task
+
+    with patch(f"{BASE_PATH}.deploy_crd_definition"):
+        run_sync(_reconcile())
+
+    assert stats["failing"].failures == 1
+    assert stats["healthy"].successes == 1
+    assert stats["healthy"].failures == 0
+
+
+def test_get_cluster_metrics():
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    memo = {"cluster_stats": {"cluster-a": iam_mapping.ClusterStats(successes=3)}}
+
+    metrics = iam_mapping.get_cluster_metrics(memo=memo)
+
+    assert metrics["cluster-a"]["successes"] == 3
+    assert metrics["cluster-a"]["failures"] == 0
+
+
+def test_get_cluster_metrics_single_cluster_mode():
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    assert not iam_mapping.get_cluster_metrics(memo={})
+
+
+@patch.dict(environ, {"KUBE_CONTEXTS": "cluster-a,cluster-b"})
+def test_start_multi_cluster(create_mock_coroutine):
+    import kopf
+
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    reconcile_mock, _ = create_mock_coroutine(to_patch=f"{BASE_PATH}.reconcile_clusters_forever")
+    memo = kopf.Memo()
+
+    async def _start():
+        await iam_mapping.start_multi_cluster(memo=memo, logger=logging.getLogger("test"))
+        await memo.multi_cluster_task
+
+    run_sync(_start())
+
+    reconcile_mock.assert_called_once_with(
+        ["cluster-a", "cluster-b"],
+        memo.cluster_clients,
+        memo.cluster_stats,
+        max_parallelism=iam_mapping.CLUSTER_SYNC_MAX_PARALLELISM,
+        interval=iam_mapping.CLUSTER_SYNC_INTERVAL,
+        timeout=iam_mapping.CLUSTER_SYNC_TIMEOUT,
+    )
+    assert set(memo.cluster_stats) == {"cluster-a", "cluster-b"}
+
+
+def test_reconcile_clusters_forever_retries_loading_clients():
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    clients = make_cluster_clients("cluster-a", request_timeout=5)
+    load_mock = MagicMock(side_effect=[RuntimeError("Could not load kubeconfig context cluster-a"), clients])
+    clients_by_context = {}
+    stats = {"cluster-a": iam_mapping.ClusterStats()}
+
+    async def _reconcile():
+        task = asyncio.create_task(
+            iam_mapping.reconcile_clusters_forever(
+                ["cluster-a"], clients_by_context, stats, max_parallelism=1, interval=0.01, timeout=5
+            )
+        )
+        while not stats["cluster-a"].successes:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with raises(asyncio.CancelledError):
+            await task
+
+    with patch(f"{BASE_PATH}.load_cluster_clients", load_mock), patch(f"{BASE_PATH}.deploy_crd_definition"):
+        run_sync(_reconcile())
+
+    load_mock.assert_called_with("cluster-a", 5)
+    assert load_mock.call_count == 2
+    assert clients_by_context == {"cluster-a": clients}
+    assert stats["cluster-a"].failures == 1
+    assert stats["cluster-a"].successes == 1
+
+
+def test_full_synchronize_prune_removes_deleted_mapping():
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    clients = make_cluster_clients("cluster-a")
+    spec_user_revoked = {
+        "groups": ["system:masters"],
+        "userarn": "arn:aws:iam::000000000000:user/revoked",
+        "username": "revoked",
+    }
+    clients.core_api.read_namespaced_config_map.return_value = make_managed_configmap(
+        [SPEC_CSEC_ADMIN, SPEC_USER_SYSTEM_NODE_TO_IGNORE, SPEC_USER_JOHNDOE, spec_user_revoked],
+        managed_identities=[SPEC_USER_JOHNDOE["username"], "revoked"],
+    )
+    clients.custom_objects_api.list_cluster_custom_object.return_value = {"items": [{"spec": SPEC_USER_JOHNDOE}]}
+
+    iam_mapping.full_synchronize(clients, prune=True)
+
+    # sdm-csec-admin was not written by the operator, it is left unchanged
+    patched_configmap = clients.core_api.patch_namespaced_config_map.call_args.args[2]
+    assert yaml.safe_load(patched_configmap.data["mapUsers"]) == [SPEC_USER_SYSTEM_NODE_TO_IGNORE, SPEC_USER_JOHNDOE]
+    assert yaml.safe_load(patched_configmap.data["mapRoles"]) == [SPEC_CSEC_ADMIN]
+    assert iam_mapping.get_managed_identities(patched_configmap) == [SPEC_USER_JOHNDOE["username"]]
+
+
+def test_full_synchronize_prune_records_managed_identities():
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    clients = make_cluster_clients("cluster-a")
+    clients.custom_objects_api.list_cluster_custom_object.return_value = {"items": [{"spec": SPEC_USER_MARK}]}
+
+    iam_mapping.full_synchronize(clients, prune=True)
+
+    # Without annotation, nothing was written by the operator yet and nothing is pruned
+    patched_configmap = clients.core_api.patch_namespaced_config_map.call_args.args[2]
+    assert yaml.safe_load(patched_configmap.data["mapUsers"]) == [SPEC_USER_JOHNDOE, SPEC_USER_MARK]
+    assert yaml.safe_load(patched_configmap.data["mapRoles"]) == [SPEC_CSEC_ADMIN]
+    assert iam_mapping.get_managed_identities(patched_configmap) == [SPEC_USER_MARK["username"]]
+
+
+def test_full_synchronize_prune_without_identity_mappings():
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    clients = make_cluster_clients("cluster-a")
+    clients.core_api.read_namespaced_config_map.return_value = make_managed_configmap(
+        [SPEC_CSEC_ADMIN, SPEC_USER_JOHNDOE], managed_identities=[SPEC_USER_JOHNDOE["username"]]
+    )
+    clients.custom_objects_api.list_cluster_custom_object.return_value = {"items": []}
+
+    iam_mapping.full_synchronize(clients, prune=True)
+
+    patched_configmap = clients.core_api.patch_namespaced_config_map.call_args.args[2]
+    assert yaml.safe_load(patched_configmap.data["mapUsers"]) == [SPEC_USER_JOHNDOE]
+    assert yaml.safe_load(patched_configmap.data["mapRoles"]) == [SPEC_CSEC_ADMIN]
+    assert iam_mapping.get_managed_identities(patched_configmap) == [SPEC_USER_JOHNDOE["username"]]
+
+
+@patch.dict(environ, {"IGNORED_CM_IDENTITIES": SPEC_CSEC_ADMIN["username"]})
+def test_full_synchronize_prune_keeps_ignored_identities_env():
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    clients = make_cluster_clients("cluster-a")
+    clients.core_api.read_namespaced_config_map.return_value = make_managed_configmap(
+        [SPEC_CSEC_ADMIN, SPEC_USER_JOHNDOE],
+        managed_identities=[SPEC_CSEC_ADMIN["username"], SPEC_USER_JOHNDOE["username"]],
+    )
+    clients.custom_objects_api.list_cluster_custom_object.return_value = {"items": [{"spec": SPEC_USER_MARK}]}
+
+    iam_mapping.full_synchronize(clients, prune=True)
+
+    patched_configmap = clients.core_api.patch_namespaced_config_map.call_args.args[2]
+    assert yaml.safe_load(patched_configmap.data["mapUsers"]) == [SPEC_USER_MARK]
+    assert yaml.safe_load(patched_configmap.data["mapRoles"]) == [SPEC_CSEC_ADMIN]
+
+
+def test_reconcile_cluster_prunes_deleted_mapping():
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    clients = make_cluster_clients("cluster-a")
+    clients.core_api.read_namespaced_config_map.return_value = make_managed_configmap(
+        [SPEC_CSEC_ADMIN, SPEC_USER_JOHNDOE],
+        managed_identities=[SPEC_CSEC_ADMIN["username"], SPEC_USER_JOHNDOE["username"]],
+    )
+    # Only johndoe is left, the IamIdentityMapping of sdm-csec-admin was deleted
+    clients.custom_objects_api.list_cluster_custom_object.return_value = {"items": [{"spec": SPEC_USER_JOHNDOE}]}
+    stats = iam_mapping.ClusterStats()
+
+    with patch(f"{BASE_PATH}.deploy_crd_definition"):
+        run_reconcile_cluster(clients, stats)
+
+    patched_configmap = clients.core_api.patch_namespaced_config_map.call_args.args[2]
+    assert yaml.safe_load(patched_configmap.data["mapUsers"]) == [SPEC_USER_JOHNDOE]
+    assert yaml.safe_load(patched_configmap.data["mapRoles"]) == []
+
+
+def test_reconcile_cluster_records_drift():
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    clients = make_cluster_clients("cluster-a")
+    clients.custom_objects_api.list_cluster_custom_object.return_value = {
+        "items": [{"spec": SPEC_USER_JOHNDOE}, {"spec": SPEC_CSEC_ADMIN}, {"spec": SPEC_USER_MARK}]
+    }
+    stats = iam_mapping.ClusterStats()
+
+    with patch(f"{BASE_PATH}.deploy_crd_definition"):
+        run_reconcile_cluster(clients, stats)
+
+    assert stats.in_sync is False
+    assert stats.drifts == 1
+    assert stats.successes == 1
+    # The configmap and the IamIdentityMappings are only fetched once per reconciliation
+    clients.core_api.read_namespaced_config_map.assert_called_once()
+    clients.custom_objects_api.list_cluster_custom_object.assert_called_once()
+
+
+def test_full_synchronize_prune_with_mapping_without_username():
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    clients = make_cluster_clients("cluster-a")
+    spec_role_without_username = {"groups": ["system:masters"], "rolearn": "arn:aws:iam::000000000000:role/admin"}
+    clients.core_api.read_namespaced_config_map.return_value = make_managed_configmap(
+        [spec_role_without_username, SPEC_CSEC_ADMIN], managed_identities=[SPEC_CSEC_ADMIN["username"]]
+    )
+    clients.custom_objects_api.list_cluster_custom_object.return_value = {"items": [{"spec": SPEC_USER_JOHNDOE}]}
+
+    assert not iam_mapping.full_synchronize(clients, prune=True)
+
+    patched_configmap = clients.core_api.patch_namespaced_config_map.call_args.args[2]
+    assert yaml.safe_load(patched_configmap.data["mapUsers"]) == [SPEC_USER_JOHNDOE]
+    assert yaml.safe_load(patched_configmap.data["mapRoles"]) == [spec_role_without_username]
+
+
+def test_reconcile_cluster_records_in_sync():
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    clients = make_cluster_clients("cluster-a")
+    clients.custom_objects_api.list_cluster_custom_object.return_value = {
+        "items": [{"spec": SPEC_USER_JOHNDOE}, {"spec": SPEC_CSEC_ADMIN}]
+    }
+    stats = iam_mapping.ClusterStats()
+
+    with patch(f"{BASE_PATH}.deploy_crd_definition"):
+        run_reconcile_cluster(clients, stats)
+
+    assert stats.in_sync is True
+    assert stats.drifts == 0
+
+
+def test_get_monitoring_status_records_local_cluster(api_client, custom_objects_api):
+    import kopf
+
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    api_client.read_namespaced_config_map.return_value = make_managed_configmap([SPEC_CSEC_ADMIN, SPEC_USER_JOHNDOE])
+    custom_objects_api.list_cluster_custom_object.return_value = {"items": [{"spec": SPEC_USER_JOHNDOE}]}
+    memo = kopf.Memo()
+
+    with raises(RuntimeError):
+        iam_mapping.get_monitoring_status(memo=memo)
+    # The local cluster is not repaired between two checks, this is still the same drift
+    with raises(RuntimeError):
+        iam_mapping.get_monitoring_status(memo=memo)
+
+    metrics = iam_mapping.get_cluster_metrics(memo=memo)
+    assert metrics["local"]["in_sync"] is False
+    assert metrics["local"]["drifts"] == 1
+
+    custom_objects_api.list_cluster_custom_object.return_value = {
+        "items": [{"spec": SPEC_USER_JOHNDOE}, {"spec": SPEC_CSEC_ADMIN}]
+    }
+    assert iam_mapping.get_monitoring_status(memo=memo)
+    assert memo.cluster_stats["local"].in_sync is True
+
+
+def test_get_monitoring_status_records_local_cluster_failure(api_client, custom_objects_api):
+    import kopf
+
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    api_client.read_namespaced_config_map.side_effect = client.ApiException(status=500, reason="unavailable")
+    memo = kopf.Memo()
+    memo.cluster_stats = {"local": iam_mapping.ClusterStats(in_sync=True)}
+
+    with raises(client.ApiException):
+        iam_mapping.get_monitoring_status(memo=memo)
+
+    stats = memo.cluster_stats["local"]
+    assert stats.in_sync is None
+    assert stats.failures == 1
+    assert "unavailable" in stats.last_error
+    assert stats.drifts == 0
+
+
+def test_on_startup_records_local_cluster(mock_apply_identity_mappings, api_client, custom_objects_api):
+    import kopf
+
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    memo = kopf.Memo()
+
+    with patch(f"{BASE_PATH}.deploy_crd_definition"):
+        iam_mapping.on_startup(memo=memo, logger=logging.getLogger("test"))
+
+    assert memo.cluster_stats["local"].successes == 1
+    assert memo.cluster_stats["local"].last_success is not None
+
+
+def test_on_startup_records_local_cluster_failure(api_client):
+    import kopf
+
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    api_client.read_namespaced_config_map.side_effect = Exception("unreachable")
+    memo = kopf.Memo()
+
+    with patch(f"{BASE_PATH}.deploy_crd_definition"), raises(Exception):
+        iam_mapping.on_startup(memo=memo, logger=logging.getLogger("test"))
+
+    stats = memo.cluster_stats["local"]
+    assert stats.successes == 0
+    assert stats.failures == 1
+    assert stats.last_error == "unreachable"
+    assert stats.last_duration is not None
+
+
+def test_stop_multi_cluster_closes_clients():
+    import kopf
+
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    clients = make_cluster_clients("cluster-a")
+    memo = kopf.Memo()
+    memo.cluster_clients = {"cluster-a": clients}
+
+    async def _stop():
+        memo.multi_cluster_task = asyncio.create_task(asyncio.sleep(60))
+        await iam_mapping.stop_multi_cluster(memo=memo)
+
+    run_sync(_stop())
+
+    assert memo.multi_cluster_task.cancelled()
+    clients.core_api.api_client.close.assert_called_once()
+
+
+def test_reconcile_cluster_timeout_keeps_semaphore_until_done():
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    clients = make_cluster_clients("cluster-a")
+    configmap = clients.core_api.read_namespaced_config_map.return_value
+    release = threading.Event()
+    clients.core_api.read_namespaced_config_map.side_effect = lambda *_, **__: release.wait(5) and configmap
+    stats = iam_mapping.ClusterStats()
+
+    async def _reconcile():
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            semaphore = asyncio.Semaphore(1)
+            await iam_mapping.reconcile_cluster(clients.name, {clients.name: clients}, stats, executor, semaphore, 0.01)
+            # The worker thread still calls the API, so the slot is not available to another cluster
+            assert semaphore.locked()
+            release.set()
+            while stats.in_flight:
+                await asyncio.sleep(0.01)
+            assert not semaphore.locked()
+
+    with patch(f"{BASE_PATH}.deploy_crd_definition"):
+        run_sync(_reconcile())
+
+    assert stats.timeouts == 1
+
+
+@patch.dict(environ, {"KUBE_CONTEXTS": "cluster-a", "CLUSTER_SYNC_MAX_PARALLELISM": "0"})
+def test_start_multi_cluster_rejects_invalid_parallelism():
+    import kopf
+
+    import src.kubernetes_operator.iam_mapping as iam_mapping
+
+    memo = kopf.Memo()
+
+    with raises(kopf.PermanentError):
+        run_sync(iam_mapping.start_multi_cluster(memo=memo, logger=logging.getLogger("test")))
+
+    assert "multi_cluster_task" not in memo